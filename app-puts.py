@@ -1,21 +1,54 @@
 import streamlit as st
 import requests
-import csv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+import functools
+import orjson
+import numpy as np
 import pandas as pd
+from openpyxl import Workbook
 import io
+import sqlite3
 import time
+from contextlib import closing
 
 BASE_URL = "https://buurfashion.itsperfect.it/api/v3"
 MAX_RATE_LIMIT_SLEEP = 10
+RATE_LIMIT_RESERVE = 2  # marbles kept free in the bucket
+SECONDS_PER_MARBLE = 4  # how long the bucket takes to leak one marble
+MAX_CONCURRENT_REQUESTS = 32
+PUT_LINES_CACHE = "put_lines_cache.sqlite"
+KEY_CODE_BITS = 21  # bits per factorized join key; three keys packed into one int64
+
+def new_session():
+    """Pooled session for the sync API calls; 429s and transient 5xx are retried with backoff by urllib3."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=MAX_CONCURRENT_REQUESTS,
+        pool_maxsize=MAX_CONCURRENT_REQUESTS,
+        max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False),
+    ))
+    return session
+
+def get_session():
+    """The current user's session, kept in st.session_state so its connections survive reruns.
+
+    Not shared between users: cookies and connection state stay with one browser session.
+    """
+    if "http_session" not in st.session_state:
+        st.session_state["http_session"] = new_session()
+    return st.session_state["http_session"]
 
 # --- Helper Functions ---
 
 def get_bearer_token(username, password):
     url = f"{BASE_URL}/authentication"
     data = {"username": username, "password": password}
-    resp = requests.post(url, json=data)
+    resp = get_session().post(url, json=data)
     resp.raise_for_status()
-    resp_data = resp.json()
+    resp_data = orjson.loads(resp.content)
     token = resp_data["token"]
     expires_in = resp_data.get("expires_in", 1740)
     expiry_timestamp = time.time() + expires_in - 60
@@ -34,194 +67,328 @@ def ensure_valid_token():
         st.session_state["token_expiry"] = expiry
     return st.session_state["token"]
 
+def rate_limit_wait(headers):
+    """Seconds until enough marbles have leaked to be above the reserve again, else 0."""
+    bucket_size = int(headers.get("X-Bucket-Size", 100))
+    marbles = int(headers.get("X-Marbles-In-Bucket", 0))
+    remaining = int(headers.get("X-Remaining-Requests", bucket_size))
+    free = min(remaining, bucket_size - marbles)
+    if free <= RATE_LIMIT_RESERVE:
+        calculated_wait = (RATE_LIMIT_RESERVE + 1 - free) * SECONDS_PER_MARBLE
+        wait_time = min(calculated_wait, MAX_RATE_LIMIT_SLEEP)
+        print(f"[rate_limit_wait] Bucket near/full. Waiting {wait_time}s (calc {calculated_wait}s).")
+        return wait_time
+    return 0
+
 def handle_rate_limits(resp):
-    bucket_size = int(resp.headers.get("X-Bucket-Size", 100))
-    marbles = int(resp.headers.get("X-Marbles-In-Bucket", 0))
-    remaining = int(resp.headers.get("X-Remaining-Requests", bucket_size))
-    if marbles >= bucket_size - 2 or remaining <= 2:
-        calculated_wait = (marbles - remaining + 2) * 4
-        wait_time = min(max(calculated_wait, 1), MAX_RATE_LIMIT_SLEEP)
-        print(f"[handle_rate_limits] Bucket near/full. Sleeping {wait_time}s (calc {calculated_wait}s).")
+    wait_time = rate_limit_wait(resp.headers)
+    if wait_time:
         time.sleep(wait_time)
     return
 
 def safe_get(url, headers, params=None, log_text=None):
-    while True:
-        print(f"[safe_get] {log_text or ''} -> {url} params={params}")
-        resp = requests.get(url, headers=headers, params=params)
-        if resp.status_code == 429:
-            print("[safe_get] 429 received. Sleeping 3 seconds before retry.")
-            time.sleep(3)
-            continue
-        handle_rate_limits(resp)
-        return resp
-
-# ---- Normalizers ----
+    print(f"[safe_get] {log_text or ''} -> {url} params={params}")
+    resp = get_session().get(url, headers=headers, params=params)
+    handle_rate_limits(resp)
+    return resp
 
-def normalize_order_number(x):
-    # Treat NaN/None as empty and avoid turning them into "nan"
-    if x is None or (isinstance(x, float) and pd.isna(x)) or (isinstance(x, str) and x.strip().lower() in ("", "nan", "none")):
-        return ""
-    s = str(x).strip()
-    if s.endswith('.0'):
-        s = s[:-2]
-    return s
-
-def normalize_item_number(x):
-    """Stringify, remove trailing .0, then strip leading zeros (API '0005990' -> '5990')."""
-    s = str(x).strip()
-    if s.endswith('.0'):
-        s = s[:-2]
-    s = s.lstrip('0')
-    return s if s else '0'
-
-def normalize_kleurnummer(kleurnummer):
-    """Pad to 3 or 4 digits as your sheet expects, but also remove trailing .0 if present."""
-    s = str(kleurnummer).strip()
-    if s.endswith('.0'):
-        s = s[:-2]
-    if s.isdigit():
-        return s.zfill(3 if len(s) <= 2 else 4)
-    return s
-
-def strip_leading_zeros(x):
-    s = str(x).lstrip('0')
-    return s if s else '0'
+class AsyncBucketLimiter:
+    """Shares the API's marble bucket between concurrent async requests.
 
-# ---- API fetchers with pagination ----
+    acquire() takes a marble before a request is sent; release() feeds the bucket headers of the
+    response back in. Once the bucket is (nearly) full, new requests wait until it has refilled
+    instead of running into 429s.
+    """
 
-def get_all_puts():
-    token = ensure_valid_token()
-    put_ids = []
-    current_page = 1
+    def __init__(self, bucket_size=100, reserve=RATE_LIMIT_RESERVE):
+        self.bucket_size = bucket_size
+        self.reserve = reserve
+        # Let a single request through until a response reports the real bucket state
+        self.remaining = reserve + 1
+        self.refill_at = 0.0
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                delay = self.refill_at - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.remaining > self.reserve or not self.in_flight:
+                    # Enough marbles left, or nothing in flight to report fresh state: send (a probe)
+                    break
+                else:
+                    await self._cond.wait()
+            self.remaining -= 1
+            self.in_flight += 1
+
+    async def release(self, headers=None):
+        async with self._cond:
+            self.in_flight -= 1
+            if headers is not None:
+                self.bucket_size = int(headers.get("X-Bucket-Size", self.bucket_size))
+                remaining = int(headers.get("X-Remaining-Requests", self.bucket_size))
+                # Requests still in flight were let through against the previous count
+                self.remaining = remaining - self.in_flight
+                wait_time = rate_limit_wait(headers)
+                if wait_time:
+                    self.refill_at = max(self.refill_at, time.monotonic() + wait_time)
+            self._cond.notify_all()
+
+async def async_safe_get(session, limiter, url, headers=None, log_text=None):
+    """Async counterpart of safe_get, backing off exponentially on 429.
+
+    The bearer token is read right before every attempt, after waiting for the limiter, so long
+    fetches pick up a refreshed token; pass only extra headers.
+    Returns (parsed JSON body, response headers); the body is None on 304 Not Modified.
+    """
+    backoff = 1
     while True:
-        url = f"{BASE_URL}/puts?status=0&limit=1000&page={current_page}"
-        headers = {"Authorization": f"Bearer {token}"}
-        resp = safe_get(url, headers, log_text=f"[GET] /puts page {current_page}")
-        resp.raise_for_status()
-        data = resp.json()
-        put_ids.extend([put["id"] for put in data if "id" in put])
-
+        await limiter.acquire()
+        resp_headers = None
         try:
-            current = int(resp.headers.get('X-Pagination-Current-Page', current_page))
-            total_pages = int(resp.headers.get('X-Pagination-Page-Count', current))
-        except Exception:
-            break  # if headers missing, assume single page
+            token = ensure_valid_token()
+            request_headers = {**(headers or {}), "Authorization": f"Bearer {token}"}
+            print(f"[async_safe_get] {log_text or ''} -> {url}")
+            async with session.get(url, headers=request_headers) as resp:
+                resp_headers = resp.headers
+                if resp.status == 304:
+                    return None, resp_headers
+                if resp.status != 429:
+                    resp.raise_for_status()
+                    return orjson.loads(await resp.read()), resp_headers
+        finally:
+            await limiter.release(resp_headers)
+        print(f"[async_safe_get] 429 received. Sleeping {backoff} seconds before retry.")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, MAX_RATE_LIMIT_SLEEP)
 
-        if current >= total_pages:
-            break
-        current_page += 1
-    return put_ids
+# ---- Normalizers ----
 
-def get_put_lines(put_id):
+# Each normalizer takes and returns a whole column (pd.Series), using vectorized .str ops.
+
+def per_distinct_value(normalize):
+    """Run a column normalizer on the distinct values only and map the result back onto the rows."""
+    @functools.wraps(normalize)
+    def wrapper(s):
+        codes, uniques = pd.factorize(s, use_na_sentinel=False)
+        result = normalize(pd.Series(uniques)).take(codes)
+        result.index = s.index
+        return result
+    return wrapper
+
+@per_distinct_value
+def normalize_order_number(s):
+    """Stringify, remove trailing .0; NaN/None become empty instead of "nan"."""
+    s = s.astype(str).str.strip().fillna("")
+    empty = s.str.lower().isin(["", "nan", "none"])
+    return s.str.removesuffix('.0').where(~empty, "")
+
+@per_distinct_value
+def normalize_item_number(s):
+    """Stringify, remove trailing .0, then strip leading zeros (API '0005990' -> '5990'); blank cells stay ""."""
+    blank = s.isna()
+    s = s.fillna("").astype(str).str.strip().str.removesuffix('.0').str.lstrip('0')
+    return s.where(s != "", '0').mask(blank, "")
+
+@per_distinct_value
+def normalize_kleurnummer(s):
+    """Pad to 3 or 4 digits as your sheet expects, but also remove trailing .0 if present; blank cells stay ""."""
+    s = s.fillna("").astype(str).str.strip().str.removesuffix('.0')
+    padded = s.str.zfill(3).where(s.str.len() <= 2, s.str.zfill(4))
+    return padded.where(s.str.isdigit().fillna(False).astype(bool), s)
+
+def strip_leading_zeros(s):
+    s = s.astype(str).str.lstrip('0')
+    return s.where(s != "", '0')
+
+# ---- API fetchers with pagination ----
+
+def get_first_puts_page():
+    """Page 1 of /puts, plus the page count from its pagination headers."""
     token = ensure_valid_token()
-    url = f"{BASE_URL}/puts/{put_id}/lines?limit=1000"
+    url = f"{BASE_URL}/puts?status=0&limit=1000&page=1"
     headers = {"Authorization": f"Bearer {token}"}
-    resp = safe_get(url, headers, log_text=f"[GET] /puts/{put_id}/lines")
+    resp = safe_get(url, headers, log_text="[GET] /puts page 1")
     resp.raise_for_status()
-    return resp.json()
+    data = orjson.loads(resp.content)
+    put_ids = [put["id"] for put in data if "id" in put]
 
-# ---- Build CSV buffer with line quantities (integer strings) ----
-
-def fetch_put_lines_csv(username, password):
+    try:
+        total_pages = int(resp.headers.get('X-Pagination-Page-Count', 1))
+    except Exception:
+        total_pages = 1  # if headers missing, assume single page
+    return put_ids, total_pages
+
+async def get_puts_page(session, limiter, page):
+    url = f"{BASE_URL}/puts?status=0&limit=1000&page={page}"
+    data, _ = await async_safe_get(session, limiter, url, log_text=f"[GET] /puts page {page}")
+    return [put["id"] for put in data if "id" in put]
+
+# ---- On-disk cache of PUT lines, revalidated with If-Modified-Since ----
+
+def open_put_lines_cache(put_ids):
+    """Connection to the cache with the current put_ids in the temp table current_puts."""
+    conn = sqlite3.connect(PUT_LINES_CACHE)
+    conn.execute("CREATE TABLE IF NOT EXISTS put_lines (put_id TEXT PRIMARY KEY, lines TEXT, last_modified TEXT)")
+    conn.execute("CREATE TEMP TABLE current_puts (put_id TEXT PRIMARY KEY)")
+    conn.executemany("INSERT OR IGNORE INTO current_puts VALUES (?)", [(str(put_id),) for put_id in put_ids])
+    return conn
+
+def load_put_lines_cache(put_ids):
+    """{put_id: (lines, last_modified)} for the requested PUTs that have a cached copy."""
+    with closing(open_put_lines_cache(put_ids)) as conn:
+        rows = conn.execute(
+            "SELECT put_id, lines, last_modified FROM put_lines WHERE put_id IN (SELECT put_id FROM current_puts)"
+        ).fetchall()
+    return {put_id: (orjson.loads(lines), last_modified) for put_id, lines, last_modified in rows}
+
+def save_put_lines_cache(put_ids, updates):
+    """Store {put_id: (lines, last_modified)} and drop PUTs that are no longer open, in a single transaction."""
+    with closing(open_put_lines_cache(put_ids)) as conn, conn:
+        conn.execute("DELETE FROM put_lines WHERE put_id NOT IN (SELECT put_id FROM current_puts)")
+        conn.executemany(
+            "INSERT OR REPLACE INTO put_lines (put_id, lines, last_modified) VALUES (?, ?, ?)",
+            [(put_id, orjson.dumps(lines), last_modified) for put_id, (lines, last_modified) in updates.items()],
+        )
+
+async def get_put_lines(session, limiter, cache, put_id):
+    """Returns (lines, last_modified); last_modified is None when there is nothing new to cache."""
+    url = f"{BASE_URL}/puts/{put_id}/lines?limit=1000"
+    headers = {}
+    cached = cache.get(str(put_id))
+    if cached:
+        headers["If-Modified-Since"] = cached[1]
+    lines, resp_headers = await async_safe_get(session, limiter, url, headers, log_text=f"[GET] /puts/{put_id}/lines")
+    if lines is None:  # 304 Not Modified
+        return cached[0], None
+    return lines, resp_headers.get("Last-Modified")
+
+async def get_all_put_lines(first_page_ids, total_pages, progress):
+    """Fetch the remaining /puts pages, then the lines of every PUT, concurrently.
+
+    Returns (put_ids, lines per PUT in the same order).
+    """
+    done = 0
+    updates = {}
+    limiter = AsyncBucketLimiter()
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        pages = await asyncio.gather(*[get_puts_page(session, limiter, page) for page in range(2, total_pages + 1)])
+        put_ids = first_page_ids + [put_id for page_ids in pages for put_id in page_ids]
+        n_puts = len(put_ids)
+        cache = load_put_lines_cache(put_ids)
+
+        async def fetch(put_id):
+            nonlocal done
+            lines, last_modified = await get_put_lines(session, limiter, cache, put_id)
+            if last_modified:
+                updates[str(put_id)] = (lines, last_modified)
+            done += 1
+            print(f"Processed PUT {done}/{n_puts} (PUT ID: {put_id})")
+            progress.progress(done / max(n_puts, 1))
+            return lines
+
+        all_lines = await asyncio.gather(*[fetch(put_id) for put_id in put_ids])
+
+    save_put_lines_cache(put_ids, updates)
+    return put_ids, all_lines
+
+# ---- Build DataFrame with normalized line fields and integer quantities ----
+
+def fetch_put_lines(username, password):
     st.session_state["username"] = username
     st.session_state["password"] = password
 
-    put_ids = get_all_puts()
+    first_page_ids, total_pages = get_first_puts_page()
 
-    csv_buffer = io.StringIO()
-    writer = csv.writer(csv_buffer)
-    writer.writerow(["put_id", "line_id", "po_number", "item_number", "color_number", "quantity"])
-
-    n_puts = len(put_ids)
     progress = st.progress(0)
-    for idx, put_id in enumerate(put_ids):
-        print(f"Processing PUT {idx+1}/{n_puts} (PUT ID: {put_id})")
-        lines = get_put_lines(put_id)
+    put_ids, all_lines = asyncio.run(get_all_put_lines(first_page_ids, total_pages, progress))
+
+    records = []
+    for put_id, lines in zip(put_ids, all_lines):
         for line in lines:
             item = line.get("item") or {}
             color = line.get("color") or {}
-            line_id = line.get("id")
-            po_number = line.get("order_id")
-            item_number = str(item.get("item_number", "")).strip()
-            color_number = str(color.get("color_number", "")).strip()
-
-            # quantity: strip decimals (e.g. '79.00' -> '79')
-            raw_quantity = str(line.get("quantity", "0")).strip()
-            quantity = raw_quantity.split(".")[0] if "." in raw_quantity else raw_quantity
-
-            writer.writerow([
+            records.append((
                 put_id,
-                line_id,
-                po_number,
-                normalize_item_number(item_number),
-                normalize_kleurnummer(color_number),
-                quantity
-            ])
-        progress.progress((idx + 1) / max(n_puts, 1))
-    csv_buffer.seek(0)
-    return csv_buffer
+                line.get("id"),
+                line.get("order_id"),
+                str(item.get("item_number", "")).strip(),
+                str(color.get("color_number", "")).strip(),
+                line.get("quantity", "0"),
+            ))
+
+    df_csv = pd.DataFrame.from_records(
+        records, columns=["put_id", "line_id", "po_number", "item_number", "color_number", "quantity"]
+    )
+    df_csv['put_id'] = normalize_order_number(df_csv['put_id'])
+    df_csv['po_number'] = normalize_order_number(df_csv['po_number'])
+    df_csv['item_number'] = normalize_item_number(df_csv['item_number'])
+    # Digit-only color codes lost their leading zeros when the old CSV was parsed back; keep that before padding
+    colors = df_csv['color_number'].str.removesuffix('.0')
+    colors = colors.where(~colors.str.isdigit(), strip_leading_zeros(colors))
+    df_csv['color_number'] = normalize_kleurnummer(colors)
+    # quantity: strip decimals (e.g. '79.00' -> 79)
+    df_csv['quantity'] = pd.to_numeric(df_csv['quantity'], errors='coerce').fillna(0).astype(int)
+    return df_csv
 
 # ---- Merge into Excel ----
 
-def merge_put_lines_to_excel(excel_file, csv_buffer):
-    df_excel = pd.read_excel(excel_file)
-    df_csv = pd.read_csv(csv_buffer)
+def merge_put_lines_to_excel(excel_file, df_csv):
+    """df_csv is the already normalized frame from fetch_put_lines."""
+    df_excel = pd.read_excel(excel_file, engine='calamine')
 
     # Clean headers
     df_excel.columns = [c.strip() for c in df_excel.columns]
-    df_csv.columns = [c.strip() for c in df_csv.columns]
 
-    # Normalize CSV fields
-    df_csv['put_id']      = df_csv['put_id'].apply(normalize_order_number)
-    df_csv['po_number']   = df_csv['po_number'].apply(normalize_order_number)
-    df_csv['item_number'] = df_csv['item_number'].apply(normalize_item_number)
-    df_csv['color_number']= df_csv['color_number'].apply(normalize_kleurnummer)
-    df_csv['quantity']    = pd.to_numeric(df_csv['quantity'], errors='coerce').fillna(0).astype(int)
-
-    # Normalize Excel fields (for matching & nice output)
+    # Normalize Excel fields once, for matching and as the output form
+    # (Artikelnummer without leading zeros, Ordernr. without trailing .0, blank PUT as "")
     if 'PUT' in df_excel.columns:
-        df_excel['PUT'] = df_excel['PUT'].apply(normalize_order_number)
-        # ensure no literal 'nan' strings or real NaNs
-        df_excel['PUT'] = df_excel['PUT'].replace({"nan": "", "NaN": "", None: ""}).fillna("")
+        df_excel['PUT'] = normalize_order_number(df_excel['PUT'])
 
     if 'Ordernr.' in df_excel.columns:
-        df_excel['Ordernr.'] = df_excel['Ordernr.'].apply(normalize_order_number)
+        df_excel['Ordernr.'] = normalize_order_number(df_excel['Ordernr.'])
     if 'Artikelnummer' in df_excel.columns:
-        df_excel['Artikelnummer'] = df_excel['Artikelnummer'].apply(normalize_item_number)
+        df_excel['Artikelnummer'] = normalize_item_number(df_excel['Artikelnummer'])
     if 'Kleurnummer' in df_excel.columns:
-        df_excel['Kleurnummer'] = df_excel['Kleurnummer'].apply(normalize_kleurnummer)
-
-    # Build 3-key mapping: (po_number, item_number, color_number) -> put_id
-    mapping = {}
-    for _, row in df_csv.iterrows():
-        key = (str(row['po_number']), str(row['item_number']), str(row['color_number']))
-        if key not in mapping:
-            mapping[key] = str(row['put_id'])
-
-    # Fill PUT if empty
-    def fill_put(row):
-        val = row.get('PUT', "")
-        if pd.isna(val) or str(val).strip() in ("", "nan", "NaN"):
-            key = (
-                str(row.get('Ordernr.', '')).strip(),
-                str(row.get('Artikelnummer', '')).strip(),
-                str(row.get('Kleurnummer', '')).strip()
-            )
-            return mapping.get(key, "")
-        return val
-
-    df_excel['PUT'] = df_excel.apply(fill_put, axis=1)
-    df_excel['PUT'] = df_excel['PUT'].replace({"nan": "", "NaN": "", None: ""}).fillna("")
-
-    # Pretty output: Artikelnummer without leading zeros; Ordernr. without trailing .0
-    if 'Artikelnummer' in df_excel.columns:
-        df_excel['Artikelnummer'] = df_excel['Artikelnummer'].apply(strip_leading_zeros)
-    if 'Ordernr.' in df_excel.columns:
-        df_excel['Ordernr.'] = df_excel['Ordernr.'].apply(normalize_order_number)
+        df_excel['Kleurnummer'] = normalize_kleurnummer(df_excel['Kleurnummer'])
+
+    # Fill PUT if empty: look up (po_number, item_number, color_number) -> put_id,
+    # first put_id wins when a key occurs more than once
+    csv_keys = ['po_number', 'item_number', 'color_number']
+    excel_keys = ['Ordernr.', 'Artikelnummer', 'Kleurnummer']
+    if 'PUT' not in df_excel.columns:
+        df_excel['PUT'] = ""
+    if all(k in df_excel.columns for k in excel_keys):
+        # Factorize each key over both frames and pack the three codes into one int64,
+        # so the lookup hashes integers instead of string tuples
+        n_csv = len(df_csv)
+        packed = np.zeros(n_csv + len(df_excel), dtype=np.int64)
+        for csv_key, excel_key in zip(csv_keys, excel_keys):
+            values = pd.concat([df_csv[csv_key], df_excel[excel_key]], ignore_index=True)
+            codes, uniques = pd.factorize(values, use_na_sentinel=False)
+            if len(uniques) >= 1 << KEY_CODE_BITS:
+                # Codes would spill into the neighbouring key's bits and match the wrong PUT
+                raise ValueError(f"Too many distinct values in '{excel_key}' / '{csv_key}' to pack the join key")
+            packed = (packed << KEY_CODE_BITS) | codes
+        put_map = pd.Series(df_csv['put_id'].to_numpy(), index=packed[:n_csv])
+        put_map = put_map[~put_map.index.duplicated(keep='first')]
+        found_put = pd.Series(packed[n_csv:], index=df_excel.index).map(put_map).fillna("")
+    else:
+        found_put = ""
+    df_excel['PUT'] = df_excel['PUT'].mask(df_excel['PUT'] == "", found_put)
 
     # Sum quantities PER PUT id
-    received_quantity = df_csv.groupby('put_id')['quantity'].sum().astype(int).to_dict()
+    codes, put_ids = pd.factorize(df_csv['put_id'])
+    sums = np.zeros(len(put_ids), dtype=np.int64)
+    np.add.at(sums, codes, df_csv['quantity'].to_numpy(np.int64))
+    received_quantity = pd.Series(sums, index=put_ids).astype(str)
 
     # Find or create the column for received quantities
     col_name = None
@@ -234,27 +401,28 @@ def merge_put_lines_to_excel(excel_file, csv_buffer):
         insert_at = 8 if 0 <= 8 <= len(df_excel.columns) else len(df_excel.columns)
         df_excel.insert(insert_at, col_name, "")
 
-    # Logic: update only if blank/empty/NaN or 0
-    def should_update(q):
-        if pd.isna(q):
-            return True
-        s = str(q).strip()
-        return s in ("", "0", "0.0")
-
-    def get_received_qty(row):
-        existing = row.get(col_name, "")
-        if should_update(existing):
-            put_id_key = str(row.get('PUT', '')).strip()  # already normalized
-            # Return empty string if no sum exists for this PUT id
-            return str(received_quantity.get(put_id_key, "")) if put_id_key in received_quantity else ""
-        return existing
-
-    df_excel[col_name] = df_excel.apply(get_received_qty, axis=1)
+    # Logic: update only if blank/empty/NaN or 0; empty string if no sum exists for the PUT id
+    existing = df_excel[col_name]
+    should_update = existing.isna() | existing.astype(str).str.strip().isin(["", "0", "0.0"])
+    found_qty = df_excel['PUT'].map(received_quantity).fillna("")
+    df_excel[col_name] = existing.mask(should_update, found_qty)
     # Ensure no literal 'nan' strings show up
     df_excel[col_name] = df_excel[col_name].replace({pd.NA: "", None: "", "nan": ""})
 
     return df_excel
 
+def to_excel_bytes(df):
+    """Stream df into an .xlsx with openpyxl's write-only mode, so no cell objects are kept in memory."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")  # same sheet name DataFrame.to_excel uses
+    ws.append([str(c) for c in df.columns])
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+        ws.append(row)
+    output = io.BytesIO()
+    wb.save(output)
+    output.seek(0)
+    return output
+
 # --- Streamlit UI ---
 
 st.markdown(
@@ -284,23 +452,23 @@ st.markdown(
 
 st.title("B Fashion Brands Puts Updater")
 
-# Step 1: Login and fetch PUT lines as CSV
+# Step 1: Login and fetch PUT lines
 st.header("Stap 1: Login om PUT lines op te halen")
 with st.form("auth_form"):
     username = st.text_input("Username")
     password = st.text_input("Password", type="password")
     submitted = st.form_submit_button("Fetch PUT Lines")
 
-csv_buffer = None
 if submitted:
     try:
-        with st.spinner("Fetching data and creating CSV..."):
-            csv_buffer = fetch_put_lines_csv(username, password)
+        with st.spinner("Fetching PUT lines..."):
+            df_csv = fetch_put_lines(username, password)
+            st.session_state['df_csv'] = df_csv
             st.success("PUT lines fetched successfully! Proceed to upload your 'Check Bas' Excel file.")
-            st.session_state['csv_buffer'] = csv_buffer.getvalue()
+            # Callable data: the file is only built when the user actually clicks download
             st.download_button(
                 label="Download PUT lines as CSV",
-                data=st.session_state['csv_buffer'],
+                data=lambda: df_csv.to_csv(index=False).encode(),
                 file_name="put_lines.csv",
                 mime="text/csv"
             )
@@ -310,24 +478,19 @@ if submitted:
 # Step 2: Upload Excel and merge
 st.header("Stap 2: Upload en update 'Check Bas' Excel file")
 
-if 'csv_buffer' in st.session_state:
+if 'df_csv' in st.session_state:
     excel_file = st.file_uploader("Upload 'Check Bas' Excel (.xlsx)", type=["xlsx"])
     if excel_file:
-        csv_buffer = io.StringIO(st.session_state['csv_buffer'])
         try:
             with st.spinner("Processing Excel file..."):
-                df_updated = merge_put_lines_to_excel(excel_file, csv_buffer)
+                df_updated = merge_put_lines_to_excel(excel_file, st.session_state['df_csv'])
 
             if isinstance(df_updated, pd.DataFrame) and not df_updated.empty:
                 st.success("Excel updated! Download your file below.")
                 st.dataframe(df_updated.head())
-                output = io.BytesIO()
-                with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-                    df_updated.to_excel(writer, index=False)
-                output.seek(0)
                 st.download_button(
                     label="Download Updated Excel",
-                    data=output,
+                    data=lambda: to_excel_bytes(df_updated),
                     file_name="check_bas_updated.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )